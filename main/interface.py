@@ -1,221 +1,283 @@
+import functools
+import re
+import threading
+import time
+
 import dash
 from dash import html, Input, Output, State
 import dash_bootstrap_components as dbc
 import dash_ace
 import dash_cytoscape as cyto
+import psycopg2
 from preprocessing import DBConnection, QEP
 from pipesyntax import Parser, QueryType
 
 app = dash.Dash(__name__, external_stylesheets=[dbc.themes.FLATLY])
 server = app.server
 
-app.layout = dbc.Container([
-    html.H1("SQL Query Transformer", className="mt-4 text-center"),
-
-    html.P(
-        "Input a SQL query below to view its execution plan and a pipe-syntax version of the query.",
-        className="mb-3 text-center text-secondary"
-    ),
-
-    html.Hr(style={'borderTop': '2px solid #bbb'}),
-
-    dbc.Card([
-        dbc.CardBody([
-            dbc.Row([
-                dbc.Col([
-                    html.H5("SQL Query Input"),
-                    dash_ace.DashAceEditor(
-                        id='sql-input',
-                        value='SELECT * FROM users;',
-                        theme='monokai',
-                        mode='sql',
-                        style={
-                            'minHeight': '500px',
-                            'width': '100%',
-                            'height': '100%'
-                        },
-                        tabSize=4,
-                        showPrintMargin=True,
-                        fontSize=14,
-                    ),
-                    html.Div(id='error-message', className='mt-2', style={'minHeight': '24px'}),
-                    dbc.Button("Submit", id='submit-btn', color="primary", className="mt-3")
-                ], width=4, className="p-2"),
-
-                dbc.Col([
-                    html.Div("➜", style={
-                        'fontSize': '48px',
-                        'textAlign': 'center'
-                    })
-                ], width=1, style={
-                    'height': '550px',
-                    'display': 'flex',
-                    'alignItems': 'center',
-                    'justifyContent': 'center',
-                }),
-
-                dbc.Col([
-                    html.H5("QEP Diagram"),
-                    cyto.Cytoscape(
-                        id='qep-graph',
-                        layout={
-                            'name': 'breadthfirst',
-                            'directed': True,
-                            'spacingFactor': 0.8,
-                            'padding': 0,
-                            'roots': '[id = "0_LIMIT"]',
-                        },
-                        style={
-                            'minHeight': '500px',
-                            'width': '100%',
-                            'border': '1px solid #ccc',
-                            'borderRadius': '10px',
-                            'backgroundColor': '#fdfdfd'
-                        },
-                        elements=[],
-                        stylesheet=[
-                            {
-                                'selector': 'node',
-                                'style': {
-                                    'label': 'data(label)',
-                                    'text-wrap': 'wrap',
-                                    'text-max-width': '150px',
-                                    'shape': 'roundrectangle',
-                                    'background-color': '#0074D9',
-                                    'color': 'white',
-                                    'font-size': '12px',
-                                    'padding': '8px',
-                                    'width': 'label',
-                                    'height': 'label',
-                                    'text-valign': 'center',
-                                    'text-halign': 'center'
-                                }
+# Logical operators which start a new line in long node labels
+_WRAP_RE = re.compile(r' (AND|OR|THEN|ELSE)(?= )')
+
+# A single database connection is shared by all callbacks instead of connecting on every submit
+_db = None
+_db_lock = threading.Lock()
+
+# Seconds after which a cached query is analysed again, so the plan follows changes to the data
+_CACHE_TTL = 60
+
+_CYTO_STYLESHEET = [
+    {
+        'selector': 'node',
+        'style': {
+            'label': 'data(label)',
+            'text-wrap': 'wrap',
+            'text-max-width': '150px',
+            'shape': 'roundrectangle',
+            'background-color': '#0074D9',
+            'color': 'white',
+            'font-size': '12px',
+            'padding': '8px',
+            'width': 'label',
+            'height': 'label',
+            'text-valign': 'center',
+            'text-halign': 'center'
+        }
+    },
+    {
+        'selector': 'edge',
+        'style': {
+            'curve-style': 'bezier',
+            'target-arrow-shape': 'triangle',
+            'arrow-scale': 1,
+            'line-color': '#ccc',
+            'target-arrow-color': '#ccc',
+            'width': 2
+        }
+    }
+]
+
+
+def serve_layout():
+    return dbc.Container([
+        html.H1("SQL Query Transformer", className="mt-4 text-center"),
+
+        html.P(
+            "Input a SQL query below to view its execution plan and a pipe-syntax version of the query.",
+            className="mb-3 text-center text-secondary"
+        ),
+
+        html.Hr(style={'borderTop': '2px solid #bbb'}),
+
+        dbc.Card([
+            dbc.CardBody([
+                dbc.Row([
+                    dbc.Col([
+                        html.H5("SQL Query Input"),
+                        dash_ace.DashAceEditor(
+                            id='sql-input',
+                            value='SELECT * FROM users;',
+                            theme='monokai',
+                            mode='sql',
+                            style={
+                                'minHeight': '500px',
+                                'width': '100%',
+                                'height': '100%'
                             },
-                            {
-                                'selector': 'edge',
-                                'style': {
-                                    'curve-style': 'bezier',
-                                    'target-arrow-shape': 'triangle',
-                                    'arrow-scale': 1,
-                                    'line-color': '#ccc',
-                                    'target-arrow-color': '#ccc',
-                                    'width': 2
-                                }
-                            }
-                        ],
-                        zoomingEnabled=False,
-                        userZoomingEnabled=False,
-                    )
-                ], width=5, className="p-2"),
-
-                dbc.Col([
-                    html.H5("Pipe Syntax Version"),
-                    dbc.Textarea(
-                        id='pipe-syntax-output',
-                        style={
-                            'minHeight': '500px',
-                            'width': '100%',
-                            'height': '100%',
-                            'fontFamily': 'monospace',
-                            'fontSize': '14px'
-                        },
-                        readOnly=True
-                    )
-                ], width=2, className="p-2")
-            ], style={'alignItems': 'flex-start'})
-        ])
-    ], className="shadow-sm p-3 my-4 bg-white rounded")
-], fluid=True, style={'backgroundColor': '#f8f9fa', 'minHeight': '100vh'})
+                            tabSize=4,
+                            showPrintMargin=True,
+                            fontSize=14,
+                        ),
+                        html.Div(id='error-message', className='mt-2', style={'minHeight': '24px'}),
+                        dbc.Button("Submit", id='submit-btn', color="primary", className="mt-3")
+                    ], width=4, className="p-2"),
+
+                    dbc.Col([
+                        html.Div("➜", style={
+                            'fontSize': '48px',
+                            'textAlign': 'center'
+                        })
+                    ], width=1, style={
+                        'height': '550px',
+                        'display': 'flex',
+                        'alignItems': 'center',
+                        'justifyContent': 'center',
+                    }),
+
+                    dbc.Col([
+                        html.H5("QEP Diagram"),
+                        cyto.Cytoscape(
+                            id='qep-graph',
+                            layout={'name': 'preset', 'fit': True, 'padding': 10},
+                            style={
+                                'minHeight': '500px',
+                                'width': '100%',
+                                'border': '1px solid #ccc',
+                                'borderRadius': '10px',
+                                'backgroundColor': '#fdfdfd'
+                            },
+                            elements=[],
+                            stylesheet=_CYTO_STYLESHEET,
+                            zoomingEnabled=False,
+                            userZoomingEnabled=False,
+                            autoungrabify=True,
+                            autounselectify=True,
+                        )
+                    ], width=5, className="p-2"),
+
+                    dbc.Col([
+                        html.H5("Pipe Syntax Version"),
+                        dbc.Textarea(
+                            id='pipe-syntax-output',
+                            style={
+                                'minHeight': '500px',
+                                'width': '100%',
+                                'height': '100%',
+                                'fontFamily': 'monospace',
+                                'fontSize': '14px'
+                            },
+                            readOnly=True
+                        )
+                    ], width=2, className="p-2")
+                ], style={'alignItems': 'flex-start'})
+            ])
+        ], className="shadow-sm p-3 my-4 bg-white rounded")
+    ], fluid=True, style={'backgroundColor': '#f8f9fa', 'minHeight': '100vh'})
+
+
+# Dash calls the factory once here to validate it and then again on every page load, which builds a fresh tree per page
+app.layout = serve_layout
 
 
 def qep_to_graph_elements(unfiltered_qep_list):
-    elements = []
-    node_id_map = {}
-    node_counter = 0
+    nodes = []
+    edges = []
+    node_ids = []
     join_children_map = {}
 
-    qep_list = [step for step in unfiltered_qep_list if list(step.keys())[0].name != 'WHERE']
+    # Steps are (query_type, metadata) tuples; WHERE steps are only shown in the pipe syntax
+    qep_list = [step for step in unfiltered_qep_list if step[0].name != 'WHERE']
+    names = [query_type.name for query_type, _ in qep_list]
 
-    for step in qep_list:
-        query_type, metadata = list(step.items())[0]
-        node_id = f"{node_counter}_{query_type.name}"
+    def fmt(k, v):
+        s = str(v)
+        if len(s) > 40:
+            # Add newlines before logical operators for better wrapping
+            s = _WRAP_RE.sub(r'\n\1', s)
+        return f"{k}: {s}"
 
-        def fmt(k, v):
-            s = str(v)
-            if len(s) > 40:
-                # Add newlines after logical operators for better wrapping
-                s = s.replace(" AND ", "\nAND ")
-                s = s.replace(" OR ", "\nOR ")
-                s = s.replace(" THEN ", "\nTHEN ")
-                s = s.replace(" ELSE ", "\nELSE ")
-            return f"{k}: {s}"
+    for idx, (query_type, metadata) in enumerate(qep_list):
+        node_id = f"{idx}_{names[idx]}"
 
         label_lines = [fmt(k, v) for k, v in metadata.items()]
-        label = f"{query_type.name}\n" + "\n".join(label_lines)
-
-        elements.append({
-            'data': {'id': node_id, 'label': label},
-            'position': {'x': 0, 'y': node_counter * 220}
-        })
-
-        node_id_map[node_counter] = node_id
-        node_counter += 1
-
-    for idx, step in enumerate(qep_list):
-        query_type = list(step.keys())[0]
-        if query_type.name == 'JOIN':
-            from_indices = [i for i in range(idx + 1, len(qep_list))
-                            if list(qep_list[i].keys())[0].name == 'FROM'][:2]
-            join_children_map[node_id_map[idx]] = [node_id_map[i] for i in from_indices]
-
-    for join_id, children in join_children_map.items():
-        if len(children) == 2:
-            elements = [
-                {
-                    **el,
-                    'position': {
-                        **el['position'],
-                        'x': -300 if el['data']['id'] == children[0] else
-                             300 if el['data']['id'] == children[1] else el['position']['x']
+        label = f"{names[idx]}\n" + "\n".join(label_lines)
+
+        nodes.append({'data': {'id': node_id, 'label': label}})
+        node_ids.append(node_id)
+
+        if names[idx] == 'JOIN':
+            join_children_map[idx] = [i for i in range(idx + 1, len(names)) if names[i] == 'FROM'][:2]
+
+    targets_seen = set()
+    for idx, name in enumerate(names):
+        this_id = node_ids[idx]
+
+        if name == 'JOIN':
+            for from_idx in join_children_map[idx]:
+                targets_seen.add(node_ids[from_idx])
+                edges.append({
+                    'data': {
+                        'source': this_id,
+                        'target': node_ids[from_idx]
                     }
-                } if el['data']['id'] in children else el
-                for el in elements
-            ]
-
-    for idx, step in enumerate(qep_list):
-        query_type = list(step.keys())[0]
-        this_id = node_id_map[idx]
-
-        if query_type.name == 'JOIN':
-            from_indices = [i for i in range(idx + 1, len(qep_list))
-                            if list(qep_list[i].keys())[0].name == 'FROM'][:2]
-            for from_idx in from_indices:
-                if from_idx in node_id_map:
-                    elements.append({
-                        'data': {
-                            'source': this_id,
-                            'target': node_id_map[from_idx]
-                        }
-                    })
-        elif idx < len(qep_list) - 1:
-            next_id = node_id_map[idx + 1]
-            if any(e['data'].get('target') == next_id for e in elements if 'data' in e):
+                })
+        elif idx < len(names) - 1:
+            next_id = node_ids[idx + 1]
+            if next_id in targets_seen:
                 continue
-            elements.append({
+            targets_seen.add(next_id)
+            edges.append({
                 'data': {
                     'source': this_id,
                     'target': next_id
                 }
             })
 
-    return elements
+    # Lay the edges out as a tree so the preset layout can use the positions as-is: every leaf gets its own
+    # column of 300 and a parent is centered above its children, one row of 220 per level. Nodes which
+    # cannot be reached from an earlier root start a tree of their own, so no two nodes share a position
+    node_index = {node_id: idx for idx, node_id in enumerate(node_ids)}
+    children_map = {}
+    for edge in edges:
+        children_map.setdefault(node_index[edge['data']['source']], []).append(node_index[edge['data']['target']])
+
+    tree_children = {}
+    preorder = []
+    claimed = set()
+    for root in range(len(nodes)):
+        if root in claimed:
+            continue
+        claimed.add(root)
+        plan_stack = [(root, 0)]
+        while plan_stack:
+            parent, depth = plan_stack.pop()
+            preorder.append((parent, depth))
+            children = [child for child in children_map.get(parent, []) if child not in claimed]
+            claimed.update(children)
+            tree_children[parent] = children
+            plan_stack.extend((child, depth + 1) for child in reversed(children))
+
+    x_positions = {}
+    column = 0
+    for node, _ in preorder:
+        if not tree_children[node]:
+            x_positions[node] = column * 300
+            column += 1
+    for node, _ in reversed(preorder):
+        children = tree_children[node]
+        if children:
+            x_positions[node] = (x_positions[children[0]] + x_positions[children[-1]]) / 2
+    for node, depth in preorder:
+        nodes[node]['position'] = {'x': x_positions[node], 'y': depth * 220}
+
+    # Overlapping nodes would hide each other in the preset layout
+    assert len({(node['position']['x'], node['position']['y']) for node in nodes}) == len(nodes)
+
+    return nodes + edges
+
+
+@functools.lru_cache(maxsize=128)
+def _compute(sql_query, time_bucket):
+    """
+    Runs the SQL query against Postgres and builds the outputs of the transform_sql callback
+
+    Notes:
+    Cached on the normalized SQL text, so submitting the same query again skips the database round trip
+    and the parsing of the Query Execution Plan. Failed queries raise and are therefore never cached.
+    The time bucket changes every _CACHE_TTL seconds, which makes the cached results expire.
+
+    :param sql_query: The normalized SQL query
+    :param time_bucket: The current window of _CACHE_TTL seconds, see transform_sql
+    :return: A tuple of the pipe syntax and graph elements
+    """
+    global _db
+    with _db_lock:
+        if _db is None or _db.closed:
+            _db = DBConnection()
+        try:
+            qep_list, execution_time = QEP.unwrap(sql_query, _db)
+        except psycopg2.Error:
+            # The shared connection may be left in an aborted transaction, so the next submit reconnects
+            _db.close()
+            _db = None
+            raise
+
+    # The (query_type, metadata) steps are shared by the pipe syntax and the graph
+    return Parser.parse_query(qep_list), qep_to_graph_elements(qep_list)
 
 
 @app.callback(
     Output('pipe-syntax-output', 'value'),
     Output('qep-graph', 'elements'),
-    Output('qep-graph', 'style'),
-    Output('qep-graph', 'layout'),
     Output('error-message', 'children'),
     Input('submit-btn', 'n_clicks'),
     State('sql-input', 'value'),
@@ -223,40 +285,37 @@ def qep_to_graph_elements(unfiltered_qep_list):
 )
 def transform_sql(n_clicks, sql_input):
     if not sql_input:
-        return "No SQL input provided.", [], {}
+        return "No SQL input provided.", [], ""
 
     try:
-        db = DBConnection()
-        qep_list, execution_time = QEP.unwrap(sql_input, db)
-        db.close()
-
-        pipe_syntax = Parser.parse_query(qep_list)
-        graph_elements = qep_to_graph_elements(qep_list)
-        node_count = len([e for e in graph_elements if 'target' not in e['data']])
-        height_px = max(600, 1200 + node_count * 100)
-
-        style = {
-            'width': '100%',
-            'height': f'{height_px}px',
-            'border': '1px solid #ccc',
-            'borderRadius': '10px',
-            'backgroundColor': '#fdfdfd'
-        }
-
-        # force layout to change on every query to "reset" diagram
-        first_query_type = list(qep_list[0].keys())[0]
-        root_node = f"0_{first_query_type.name}"
-
-        layout = {
-            'name': 'breadthfirst',
-            'directed': True,
-            'spacingFactor': 0.8,
-            'padding': 0,
-            'roots': f'[id = "{root_node}"]'
-        }
-
-        return pipe_syntax, graph_elements, style, layout, ""
+        # Surrounding whitespace and the trailing semicolon do not change the query
+        pipe_syntax, graph_elements = _compute(sql_input.strip().rstrip(";").strip(),
+                                               int(time.monotonic() // _CACHE_TTL))
+        return pipe_syntax, graph_elements, ""
 
     except Exception as e:
-        return "", [], {}, {}, html.Div(f"❌ Error: {str(e)}", style={"color": "red", "marginTop": "10px"})
+        return "", [], html.Div(f"❌ Error: {str(e)}", style={"color": "red", "marginTop": "10px"})
+
 
+# The layout and the graph height only depend on the elements, so they are updated in the browser.
+# The positions are computed in qep_to_graph_elements, so Cytoscape does not need to run a layout.
+app.clientside_callback(
+    """
+    function(elements, style) {
+        if (!elements || elements.length === 0) {
+            return [window.dash_clientside.no_update, window.dash_clientside.no_update];
+        }
+        const nodeCount = elements.filter(e => !('target' in e.data)).length;
+        // Only the height changes; the static style stays as declared on the component
+        return [
+            {name: 'preset', fit: true, padding: 10},
+            Object.assign({}, style, {height: Math.max(600, 1200 + nodeCount * 100) + 'px'})
+        ];
+    }
+    """,
+    Output('qep-graph', 'layout'),
+    Output('qep-graph', 'style'),
+    Input('qep-graph', 'elements'),
+    State('qep-graph', 'style'),
+    prevent_initial_call=True
+)
@@ -1,10 +1,19 @@
 import enum
+import functools
+import re
+from collections import ChainMap
+from typing import NamedTuple
 # -------------------------------------------
 #                 Enumeration
 # -------------------------------------------
 
 
 class EnumMeta(enum.EnumMeta):
+    def __init__(cls, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Lowercased member values, computed once for the substring check in __contains__
+        cls._lowered_values = tuple(str(v.value).lower() for v in cls.__members__.values())
+
     def __contains__(cls, item):
         """
 
@@ -13,9 +22,13 @@ class EnumMeta(enum.EnumMeta):
         :param item: The value of string to be checked
         :return: Boolean condition whether the value exist in Enum
         """
-        return isinstance(item, cls) or any(str(v.value).lower() in item for v in cls.__members__.values())
+        # Strings are the common case and can never be members, so they skip the isinstance check
+        if type(item) is str:
+            return any(v in item for v in cls._lowered_values)
+        return isinstance(item, cls) or any(v in item for v in cls._lowered_values)
 
 
+@enum.unique
 class Aggregate(enum.Enum, metaclass=EnumMeta):
     COUNT = "COUNT"
     SUM = "SUM"
@@ -33,13 +46,14 @@ class Aggregate(enum.Enum, metaclass=EnumMeta):
     @classmethod
     def _missing_(cls, value: object):
         if isinstance(value, str):
-            value = value.lower()
-            for member in cls:
-                if member.name.lower() == value:
-                    return member
+            return _AGGREGATE_INDEX.get(value.lower())
         return None
 
 
+_AGGREGATE_INDEX = {member.name.lower(): member for member in Aggregate}
+
+
+@enum.unique
 class Operator(enum.Enum, metaclass=EnumMeta):
     EQUAL = "="
     NOTEQUAL = "!="
@@ -57,9 +71,13 @@ class Operator(enum.Enum, metaclass=EnumMeta):
 
     @classmethod
     def to_string(cls, value: str):
-        return next(iter(list(k.replace("_", " ") for k, v in cls.__members__.items() if str(v.value) == value)), "None")
+        return _OPERATOR_BY_VALUE.get(value, "None")
+
+
+_OPERATOR_BY_VALUE = {member.value: name.replace("_", " ") for name, member in Operator.__members__.items()}
 
 
+@enum.unique
 class QueryType(enum.Enum):
     SELECT = "SELECT"
     FROM = "SCAN"
@@ -77,119 +95,185 @@ class QueryType(enum.Enum):
 
     @classmethod
     def _missing_(cls, value: object):
+        return cls.resolve(value)
+
+    @classmethod
+    def resolve(cls, value: object):
+        """
+        Resolve a plan node type into its QueryType without raising
+
+        :param value: The node type from the Query Execution Plan, e.g. "Seq Scan"
+        :return: The matching QueryType or None when the node type is not related
+        """
         if isinstance(value, str):
-            value = value.lower()
-            for member in cls:
-                if value.find(member.value.lower()) != -1:
-                    return member
+            return _resolve_query_type(value.lower())
         return None
 
 
+_QUERY_TYPE_INDEX = {member.value.lower(): member for member in QueryType}
+# Longer member values are tried first, so the more specific node types (e.g. "modifytable") short-circuit
+_QUERY_TYPE_PATTERN = re.compile("|".join(f"(?P<{member.name}>{re.escape(value)})"
+                                          for value, member in sorted(_QUERY_TYPE_INDEX.items(),
+                                                                      key=lambda item: -len(item[0]))))
+
+
+@functools.lru_cache(maxsize=256)
+def _resolve_query_type(value: str):
+    """
+    Resolve a lowercased plan node type (e.g. "seq scan", "hash join") into its QueryType
+
+    Notes:
+    Tries an exact hit on the member values first, then falls back to a single regex scan for any
+    member value contained in the node type. Node types repeat across plans, so the result is cached.
+
+    :param value: The lowercased node type from the Query Execution Plan
+    :return: The matching QueryType or None when the node type is not related
+    """
+    member = _QUERY_TYPE_INDEX.get(value)
+    if member is None:
+        match = _QUERY_TYPE_PATTERN.search(value)
+        member = QueryType[match.lastgroup] if match else None
+    return member
+
+
+class PlanNode(NamedTuple):
+    """
+    A single step of the unwrapped Query Execution Plan
+
+    Notes:
+    Still unpacks like the (QueryType, params) tuple, i.e. query_type, variables = node
+    """
+    query_type: QueryType
+    variables: dict
+
+
 # -------------------------------------------
 #      Parse Queries and helper methods
 # -------------------------------------------
 
 
-class Parser:
-    __default_syntax = "|>"
+def unpack_query(query_dict: dict) -> tuple:
+    """
+    Unpack a single-entry query dictionary into its (QueryType, params) pair
+
+    :param query_dict: Dictionary with the QueryType as its only key, e.g. {QueryType.FROM: {...}}
+    :return: A tuple of the key and its parameters
+    """
+    (query_key, query_params), = query_dict.items()
+    return query_key, query_params
+
+
+# Pipe syntax templates, filled in with format_map straight from the query parameters
+_SELECT_FMT = "|> SELECT {Index Name} \n"
+_FROM_FMT = "|> FROM {Relation Name} \n Total Time: {Actual Total Time} \n"
+_JOIN_FMT = "|> {Join Type} JOIN ON {condition}\n Total Time: {Actual Total Time} \n"
+_JOIN_FILTER_FMT = "|> {Join Type} JOIN ON {condition} AND {Filter}\n Total Time: {Actual Total Time} \n"
+_WHERE_FMT = "|> WHERE {Index Name} \n"
+_ORDER_FMT = "|> ORDER BY {Sort Key} \n Total Time: {Actual Total Time} \n"
+_LIMIT_FMT = "|> LIMIT {Plan Rows} \n Total Time: {Actual Total Time} \n"
+_AGGREGATE_FMT = "|> AGGREGATE {Index Name} GROUP BY {Group Key} \n Total Time: {Actual Total Time} \n"
+_AGGREGATE_HAVING_FMT = "|> AGGREGATE {Index Name} GROUP BY {Group Key} HAVING {Filter}\n Total Time: {Actual Total Time} \n"
+_WINDOWAGG_FMT = "|> WINDOWAGG \n Total Time: {Actual Total Time} \n"
+_UPDATE_FMT = "|> UPDATE {Relation Name} \n Total Time: {Actual Total Time} \n"
+_SET_FMT = "|> SET {Set Statement} \n"
+
+
+def _parse_select_statement(query_params: dict) -> str:
+    return _SELECT_FMT.format_map(query_params)
+
+
+def _parse_from_statement(query_params: dict) -> str:
+    return _FROM_FMT.format_map(query_params)
+
+
+def _parse_join_statement(query_params: dict) -> str:
+    condition = next((value for key, value in query_params.items() if "Cond" in key), None)
+    if query_params.get("Filter") is not None:
+        return _JOIN_FILTER_FMT.format_map(ChainMap({"condition": condition}, query_params))
+    return _JOIN_FMT.format_map(ChainMap({"condition": condition}, query_params))
+
+
+def _parse_where_statement(query_params: dict) -> str:
+    return _WHERE_FMT.format_map(query_params)
+
+
+def _parse_order_statement(query_params: dict) -> str:
+    return _ORDER_FMT.format_map(query_params)
+
+
+def _parse_limit_statement(query_params: dict) -> str:
+    return _LIMIT_FMT.format_map(query_params)
 
+
+def _parse_aggregate_statement(query_params: dict) -> str:
+    if query_params.get('Filter') is not None:
+        return _AGGREGATE_HAVING_FMT.format_map(query_params)
+    return _AGGREGATE_FMT.format_map(query_params)
+
+
+def _parse_window_aggregate_statement(query_params: dict) -> str:
+    return _WINDOWAGG_FMT.format_map(query_params)
+
+
+def _parse_update_statement(query_params: dict) -> str:
+    return _UPDATE_FMT.format_map(query_params)
+
+
+def _parse_set_statement(query_params: dict) -> str:
+    return _SET_FMT.format_map(query_params)
+
+
+# Maps every QueryType to the function which parses its statement
+_DISPATCH = {
+    QueryType.SELECT: _parse_select_statement,
+    QueryType.JOIN: _parse_join_statement,
+    QueryType.FROM: _parse_from_statement,
+    QueryType.WHERE: _parse_where_statement,
+    QueryType.ORDER: _parse_order_statement,
+    QueryType.LIMIT: _parse_limit_statement,
+    QueryType.AGGREGATE: _parse_aggregate_statement,
+    QueryType.WINDOWAGG: _parse_window_aggregate_statement,
+    QueryType.UPDATE: _parse_update_statement,
+    QueryType.SET: _parse_set_statement,
+}
+
+
+class Parser:
     @staticmethod
     def parse_query(query_list: list):
         """"
         Parse Query parses the sanitized dictionary of queries and returns the pipe syntax
-        :param query_list:
+        :param query_list: List of single-entry query dictionaries or of already unpacked (QueryType, params) tuples
         :return: tuple(str,float)
         """
 
-        order = []
-        for qep in query_list:
-            order.append(Parser.sanitize_query(qep))
-        output = ""
+        order = [Parser.sanitize_query_kv(*(qep if isinstance(qep, tuple) else unpack_query(qep)))
+                 for qep in query_list]
         order.reverse()
-        for o in order:
-            output += o
-        return output
+        return "".join(order)
 
-    @staticmethod
-    def sanitize_query(query_dict: dict) -> str:
+    @classmethod
+    def sanitize_query(cls, query_dict: dict | tuple) -> str:
         """
         Sanitize the query and force the enumeration into the respective query type
-        :param query_dict: Dictionary which contains the variables and dictionary
+        :param query_dict: Dictionary which contains the variables and dictionary,
+                           or a (QueryType, params) tuple which skips the unpacking
         :return: A string which output the parsed statement
         """
-        # Retrieve the key
-        query_key = next(iter(query_dict))
-        query = QueryType(query_key)
-        query_params = query_dict.get(query_key)
-        pipe_syntax = ""
-        match query:
-            case QueryType.SELECT:
-                pipe_syntax = Parser.__parse_select_statement(query_params)
-            case QueryType.JOIN:
-                pipe_syntax = Parser.__parse_join_statement(query_params)
-            case QueryType.FROM:
-                pipe_syntax = Parser.__parse_from_statement(query_params)
-            case QueryType.WHERE:
-                pipe_syntax = Parser.__parse_where_statement(query_params)
-            case QueryType.ORDER:
-                pipe_syntax = Parser.__parse_order_statement(query_params)
-            case QueryType.LIMIT:
-                pipe_syntax = Parser.__parse_limit_statement(query_params)
-            case QueryType.AGGREGATE:
-                pipe_syntax = Parser.__parse_aggregate_statement(query_params)
-            case QueryType.WINDOWAGG:
-                pipe_syntax = Parser.__parse_window_aggregate_statement(query_params)
-            case QueryType.UPDATE:
-                pipe_syntax = Parser.__parse_update_statement(query_params)
-            case QueryType.SET:
-                pipe_syntax = Parser.__parse_set_statement(query_params)
-        return pipe_syntax
-
-    @classmethod
-    def __parse_select_statement(cls, query_params: dict) -> str:
-        return f"{Parser.__default_syntax} SELECT {query_params['Index Name']} \n"
-
-    @classmethod
-    def __parse_from_statement(cls, query_params: dict) -> str:
-        return f"{Parser.__default_syntax} FROM {query_params['Relation Name']} \n Total Time: {query_params['Actual Total Time']} \n"
-
-    @classmethod
-    def __parse_join_statement(cls, query_params: dict) -> str:
-        condition = next(iter(map(query_params.get,filter(lambda item: "Cond" in item, query_params))),None)
-        output = f"{Parser.__default_syntax} {query_params['Join Type']} JOIN ON {condition}"
-        if query_params.get("Filter", None) is not None:
-            output += f" AND {query_params['Filter']}"
-        return output + f"\n Total Time: {query_params['Actual Total Time']} \n"
-
-    @classmethod
-    def __parse_where_statement(cls, query_params: dict) -> str:
-        return f"{Parser.__default_syntax} WHERE {query_params['Index Name']} \n"
-
-    @classmethod
-    def __parse_order_statement(cls, query_params: dict) -> str:
-        return f"{Parser.__default_syntax} ORDER BY {query_params['Sort Key']} \n Total Time: {query_params['Actual Total Time']} \n"
-
-    @classmethod
-    def __parse_limit_statement(cls, query_params: dict) -> str:
-        return f"{Parser.__default_syntax} LIMIT {query_params['Plan Rows']} \n Total Time: {query_params['Actual Total Time']} \n"
+        if isinstance(query_dict, tuple):
+            return cls.sanitize_query_kv(*query_dict)
+        return cls.sanitize_query_kv(*unpack_query(query_dict))
 
-    @classmethod
-    def __parse_aggregate_statement(cls, query_params: dict) -> str:
-        having_clause = ''
-        if 'Filter' in query_params:
-            having_clause = f"HAVING {query_params['Filter']}"
-
-        out =  f"{Parser.__default_syntax} AGGREGATE {query_params['Index Name']} GROUP BY {query_params['Group Key']} {having_clause}\n Total Time: {query_params['Actual Total Time']} \n"
-        return out 
-    
-    @classmethod
-    def __parse_window_aggregate_statement(cls, query_params: dict) -> str:
-        return f"{Parser.__default_syntax} WINDOWAGG \n Total Time: {query_params['Actual Total Time']} \n"
-    
-    @classmethod
-    def __parse_update_statement(cls, query_params: dict) -> str:
-        return f"{Parser.__default_syntax} UPDATE {query_params['Relation Name']} \n Total Time: {query_params['Actual Total Time']} \n"
-    
-    @classmethod
-    def __parse_set_statement(cls, query_params: dict) -> str:
-        return f"{Parser.__default_syntax} SET {query_params['Set Statement']} \n"
\ No newline at end of file
+    @staticmethod
+    def sanitize_query_kv(query_key, query_params: dict) -> str:
+        """
+        Parse a single step of the plan given as its key and parameters
+        :param query_key: The QueryType of the step, or a raw node type which is forced into the enumeration
+        :param query_params: The variables of the step
+        :return: A string which output the parsed statement
+        """
+        # Keys are usually QueryType members already, so the enumeration is only forced on a miss
+        parse_statement = _DISPATCH.get(query_key)
+        if parse_statement is None:
+            parse_statement = _DISPATCH.get(QueryType(query_key))
+        return parse_statement(query_params) if parse_statement is not None else ""
@@ -1,16 +1,41 @@
-import copy
-import queue
+import functools
+import logging
 import sys
+from itertools import chain
 from time import sleep
 import re
 
+import orjson
 import psycopg2
+import psycopg2.extras
 import sqlglot
 from psycopg2._psycopg import QueryCanceledError
 from psycopg2.errors import UndefinedTable, UndefinedColumn
 from sqlglot import Expression
 
-from pipesyntax import QueryType, Aggregate, Parser, Operator
+from pipesyntax import QueryType, Aggregate, Parser, Operator, PlanNode
+
+logger = logging.getLogger(__name__)
+
+# Decode the json/jsonb results, such as the EXPLAIN (FORMAT JSON) plans, with orjson instead of the json module
+psycopg2.extras.register_default_json(globally=True, loads=orjson.loads)
+psycopg2.extras.register_default_jsonb(globally=True, loads=orjson.loads)
+
+# The dialect is resolved once; it builds a fresh parser and generator per call, which keeps it thread safe
+_POSTGRES = sqlglot.Dialect.get_or_raise("postgres")
+
+# Regular expressions used while cleaning the Query Execution Plan, compiled once
+_OVER_RE = re.compile(r'over\s*\(')
+_CAST_RE = re.compile(r'::[^) ]*')
+# A table qualifier in front of a column (e.g. "customer." in "customer.c_custkey"), string literals are
+# matched first so that a full stop inside quotes is left alone. Postgres quotes mixed-case names,
+# so both the table and the column may also be a quoted identifier (e.g. "Cust"."C_id")
+_TABLE_RE = re.compile(r"""('(?:[^']|'')*')|(?:\b[A-Za-z_]\w*|"(?:[^"]|"")*")\.(?=[A-Za-z_"])""")
+_SET_RE = re.compile(r'\bSET\b\s+(.*?)(?=\bFROM\b|\bWHERE\b|;|$)', re.IGNORECASE | re.DOTALL)
+
+# Prefix which turns a query into the retrieval of its Query Execution Plan
+_EXPLAIN = "EXPLAIN (ANALYZE, FORMAT JSON)"
+
 
 class DBConnection:
     """
@@ -33,6 +58,8 @@ class DBConnection:
         self._port = port
         self._options = options
         self._conn = self._connect(self._dbname, self._username, self._password, self._port, self._options)
+        # A single cursor is reused by every execution on this connection
+        self._cur = self._conn.cursor()
 
     def __del__(self):
         self.close()
@@ -66,30 +93,106 @@ class DBConnection:
         :param query: The SQL query which is used to execute
         :param times: Number of times to execute the query when the query fails. The default is 3 times
         """
-        while times > 0:
+        return self._execute(query, times, fetch_one=False)
+
+    def execute_one(self, query, times=3):
+        """
+        Executes the query of the SQL into Postgres and only retrieves its first row
+
+        Notes:
+        Meant for queries which return a single row such as EXPLAIN, which skips building the list of rows
+
+        :param query: The SQL query which is used to execute
+        :param times: Number of times to execute the query when the query fails. The default is 3 times
+        :return: The first row of the result or None when there is no row
+        """
+        return self._execute(query, times, fetch_one=True)
+
+    def _execute(self, query, times, fetch_one):
+        """
+        Executes the query with the retries shared by execute and execute_one
+
+        :param query: The SQL query which is used to execute
+        :param times: Number of times to execute the query when the query fails
+        :param fetch_one: Whether only the first row is retrieved instead of all the rows
+        """
+        for attempt in range(times):
             try:
-                with self._conn.cursor() as cur:
-                    cur.execute(query)
-                    return cur.fetchall()
+                # A lost connection is replaced here, so a server which is still down is retried as well
+                if self._conn.closed:
+                    self._reconnect()
+                self._cur.execute(query)
+                result = self._cur.fetchone() if fetch_one else self._cur.fetchall()
+                # End the implicit transaction so a long-lived connection does not keep
+                # the changes and locks of an EXPLAIN ANALYZE on a DML statement open
+                self._conn.rollback()
+                return result
             except QueryCanceledError:
+                # The server already waited for the statement timeout, so retry straight away
                 error = QueryCanceledError("Invalid SQL. Please ensure that the SQL is valid.")
-                print("Unable to execute in time. Retrying execution...")
-                self._conn.rollback()
-                sleep(10)
-                times -= 1
-            except (UndefinedTable, UndefinedColumn):
-                error = sqlglot.TokenError("Missing SQL statement")
-                print("Error in executing statement. Retrying execution...")
-                self._conn.rollback()
-                sleep(10)
-                times -= 1
-        print("Please ensure that the query is a valid!")
+                logger.warning("Unable to execute in time. Retrying execution...")
+                self._rollback()
+            except (UndefinedTable, UndefinedColumn) as e:
+                # A missing table or column fails the same way on every retry
+                self._rollback()
+                raise sqlglot.TokenError("Missing SQL statement") from e
+            except psycopg2.OperationalError as e:
+                # Errors such as a lock timeout or a serialization failure leave the connection open
+                if not self._conn.closed:
+                    self._conn.rollback()
+                    raise
+                # The connection was lost, back off before connecting again on the next attempt
+                error = e
+                logger.warning("Lost the connection to the database. Reconnecting...")
+                if attempt < times - 1:
+                    sleep(min(2 ** attempt, 30))
+            except psycopg2.Error:
+                # Programming and data errors are deterministic, so they are raised without retrying
+                self._rollback()
+                raise
+        logger.error("Please ensure that the query is a valid!")
         raise error
 
+    def _reconnect(self):
+        """
+        Replaces the lost connection and its cursor with new ones
+        """
+        self._conn = self._connect(self._dbname, self._username, self._password, self._port, self._options)
+        self._cur = self._conn.cursor()
+
+    def _rollback(self):
+        """
+        Ends the failed transaction, unless the connection is already closed and there is nothing to roll back
+        """
+        if not self._conn.closed:
+            self._conn.rollback()
+
+    def execute_many(self, queries, times=3) -> list:
+        """
+        Executes several SQL queries one after another on the same cursor
+
+        Notes:
+        Each query is still its own round trip since every result is needed.
+        The queries are executed and rolled back separately, so a failing query does not undo the others
+
+        :param queries: An iterable of SQL queries which are used to execute
+        :param times: Number of times to execute each query when the query fails. The default is 3 times
+        :return: The list of results in the order of the queries
+        """
+        return [self.execute(query, times) for query in queries]
+
+    @property
+    def closed(self) -> bool:
+        """
+        Whether the connection to the database is closed or was lost
+        """
+        return bool(self._conn.closed)
+
     def close(self):
         """
         Closes the connection to the database
         """
+        self._cur.close()
         self._conn.close()
 
 
@@ -109,9 +212,6 @@ class QEP:
     # Join Type = Direction of the Join (Left, Right, Full)
     # Actual Total Time = Execution Time for each statement
     """
-    _conditions = ["Hash Cond", "Merge Cond", "Partial Mode", "Filter", "Relation Name", "Index Name", "Index Cond",
-                   "Scan Direction",
-                   "Join Filter", "Join Type", "Actual Total Time"]
 
     @classmethod
     def unwrap(cls, query: str, db: DBConnection) -> tuple[list, float]:
@@ -132,398 +232,491 @@ class QEP:
 
         >>> print(qep_example)
         [
-            { LIMIT: { "Plan Row": 100, "Actual Total Time": 0.55 }
-            },
-            { FROM: {"Index Name": "cust_pkey", "Relation Name": "customer",
-                      "Scan Direction": "Forward", "Actual Total Time": 1.205}
-            }
+            PlanNode( LIMIT, { "Plan Row": 100, "Actual Total Time": 0.55 }
+            ),
+            PlanNode( FROM, {"Index Name": "cust_pkey", "Relation Name": "customer",
+                              "Scan Direction": "Forward", "Actual Total Time": 1.205}
+            )
         ]
         >>> print(example_execution_time)
         1.755
 
         Coupled Functions:
-        - __unwrap_QEP(..) :ref: `unwrap_internal_label`
-        - __clean_and_replace_variables(..) :ref: `clean_label`
-        - __inject_queries(..) :ref: `inject_label`
-        - __inject_where_condition(..) :ref: `inject_where_label`
-        - __deduplicate(..) :ref: `deduplicate_label`
+        - _unwrap_QEP(..) :ref: `unwrap_internal_label`
+        - _clean_and_replace_variables(..) :ref: `clean_label`
+        - _inject_queries(..) :ref: `inject_label`
+        - _inject_where_condition(..) :ref: `inject_where_label`
+        - _deduplicate(..) :ref: `deduplicate_label`
 
         """
         parsed_query = validate_query(query)
-        alias = cls.__retrieve_alias(parsed_query)
-        query_plan_json = get_qep(query, db)
-        query_plan_json = flatten(query_plan_json)
-        execution_time = query_plan_json[0]["Execution Time"]
-        query_list = cls.__unwrap_QEP(query_plan_json[0])
-        # This section modifies the QEP dictionary object
-        # ====================================
-        # Inject the column alias from the most recent query line
-        cls.__clean_and_replace_variables(query_list, alias)
-        # Inject select into aggregate if any and aggregation
-        cls.__inject_queries(query, query_list, alias)
-        # Inject set if any update
-        cls.__inject_set_statement(query, query_list, alias)
-        # Inject where condition
-        cls.__inject_where_condition(query_list)
-        return query_list, execution_time
+        return _unwrap_plan(query, parsed_query, get_qep(query, db))
 
     @classmethod
-    def __unwrap_QEP(cls, query_plan: dict) -> list[dict]:
+    def unwrap_many(cls, queries: list[str], db: DBConnection) -> list[tuple[list, float]]:
         """
-        .. ref::_unwrap_internal_label:
+        Unwraps the Query Execution Plans of several SQL queries, see :ref: `unwrap_label`
 
+        Note:
+        Every query is validated before the first EXPLAIN is sent, so an invalid query fails the batch
+        without running any of them. The plans are then retrieved back to back on the same cursor
 
-        An internal method used to disassemble the QEP and retrieve the relevant fields from _conditions
+        :param queries: A list of SQL queries
+        :param db: The database object which is used to connect to the Postgres database :ref: `db_label`
+        :return: A list of (query list, execution time) tuples in the order of the queries
+        """
+        parsed_queries = [validate_query(query) for query in queries]
+        results = db.execute_many([_EXPLAIN + query for query in queries])
+        return [_unwrap_plan(query, parsed_query, flatten(result)[0])
+                for query, parsed_query, result in zip(queries, parsed_queries, results)]
 
-        Notes:
-        Reshape the QEP into an array of dictionary
-        Simulates a JSON dictionary with nested dictionary within a dictionary
 
-        :param query_plan: The JSON dictionary which contains the nested statements
-        :return: List of nested dictionary. View example to see the structure of the output.
+def _unwrap_plan(query: str, parsed_query: Expression, query_plan: dict) -> tuple[list, float]:
+    """
+    Turns the Query Execution Plan of a single query into the query list of :ref: `unwrap_label`
 
-        Example
+    :param query: The SQL query
+    :param parsed_query: The SQL query parsed by validate_query
+    :param query_plan: The top level of the JSON plan, which contains the "Plan" and the "Execution Time"
+    :return: Returns a tuple which contains the query list and the total execution time as a float
+    """
+    alias, subquery_alias = _retrieve_alias(parsed_query)
+    execution_time = query_plan["Execution Time"]
+    query_list = _unwrap_QEP(query_plan)
+    # This section modifies the QEP dictionary object
+    # ====================================
+    # Inject the column alias from the most recent query line
+    _clean_and_replace_variables(query_list, alias)
+    # Inject select into aggregate if any and aggregation
+    _inject_queries(query_list, alias, subquery_alias)
+    # Inject set if any update
+    _inject_set_statement(query, query_list, alias)
+    # Inject where condition
+    _inject_where_condition(query_list)
+    return query_list, execution_time
+
+
+# Fields of a plan node which are kept for the pipe syntax, see QEP for their meaning
+_CONDITIONS = frozenset({"Hash Cond", "Merge Cond", "Partial Mode", "Filter", "Relation Name", "Index Name",
+                         "Index Cond", "Scan Direction",
+                         "Join Filter", "Join Type", "Actual Total Time"})
+
+
+def _unwrap_QEP(query_plan: dict) -> list[PlanNode]:
+    """
+    .. ref::_unwrap_internal_label:
 
-        >>> print(cls.__unwrap_QEP(
-        >>> {"Plan": {"Actual Total Time": 1.275, "Plans":
-        >>>     [{"Node Type": "Limit", "Actual Total Time": 0.55, "Plan Row": 100, "Plans":
-        >>>         [{"Node Type": "Seq Index Scan", "Actual Total Time": 1}]}]}})
 
-        [
-            { LIMIT: { "Plan Row": 100, "Actual Total Time": 0.55 }
-            },
-            { FROM: {"Index Name": "cust_pkey", "Relation Name": "customer",
-                      "Scan Direction": "Forward", "Actual Total Time": 1.205}
-            }
-        ]
+    An internal method used to disassemble the QEP and retrieve the relevant fields from _CONDITIONS
 
-        Query Execution Plan
+    Notes:
+    Reshape the QEP into an array of dictionary
+    Simulates a JSON dictionary with nested dictionary within a dictionary
 
-        .. code-block:: text
+    :param query_plan: The JSON dictionary which contains the nested statements
+    :return: List of PlanNode (QueryType, variables) tuples. View example to see the structure of the output.
 
-            LIMIT
-            ├── AGGREGATE <- Finalized
-            │   ├── SORT
-            │   ├── AGGREGATE <-- Partial
-            │   │   ├── JOIN
-            │   │   │   ├── FROM
-            │   │   │   └── FROM
+    Example
 
-        Expected Output:
+    >>> print(_unwrap_QEP(
+    >>> {"Plan": {"Actual Total Time": 1.275, "Plans":
+    >>>     [{"Node Type": "Limit", "Actual Total Time": 0.55, "Plan Row": 100, "Plans":
+    >>>         [{"Node Type": "Seq Index Scan", "Actual Total Time": 1}]}]}})
+
+    [
+        ( LIMIT, { "Plan Row": 100, "Actual Total Time": 0.55 }
+        ),
+        ( FROM, {"Index Name": "cust_pkey", "Relation Name": "customer",
+                 "Scan Direction": "Forward", "Actual Total Time": 1.205}
+        )
+    ]
+
+    Query Execution Plan
+
+    .. code-block:: text
+
+        LIMIT
+        ├── AGGREGATE <- Finalized
+        │   ├── SORT
+        │   ├── AGGREGATE <-- Partial
+        │   │   ├── JOIN
+        │   │   │   ├── FROM
+        │   │   │   └── FROM
+
+    Expected Output:
+
+    .. code-block:: text
+
+        LIMIT
+        ├── AGGREGATE
+        ├── SELECT <-- Inserted
+        │   ├── SORT
+        │   │   ├── JOIN
+        │   │   │   ├── FROM
+        │   │   │   └── FROM
+    """
 
-        .. code-block:: text
+    query_plan = query_plan["Plan"]
+    query_list = []
+    # The for loop also visits the children appended while iterating, which walks the plan breadth first
+    # without popping from a queue
+    plan_queue = [query_plan]
+    for plans in plan_queue:
+        if "Plans" in plans:
+            plan_queue.extend(plans["Plans"])
+        query = QueryType.resolve(plans["Node Type"])
+        # Skip non-related Queries and Partial Aggregation before collecting any variables
+        if query is None:
+            continue
+        if query is QueryType.AGGREGATE and plans.get("Partial Mode") == "Partial":
+            continue
+        # Single pass over the node; the sort/group keys still come before the conditions
+        variable_queries = dict()
+        condition_queries = dict()
+        for query_key, query_value in plans.items():
+            if "Key" in query_key:
+                variable_queries[query_key] = query_value
+            elif query_key in _CONDITIONS:
+                condition_queries[query_key] = query_value
+        variable_queries.update(condition_queries)
+        # Only specific for limit to retrieve the condition (Plan rows)
+        # Retrieve Limit Rows
+        if query is QueryType.LIMIT:
+            variable_queries["Plan Rows"] = plans.get("Plan Rows", None)
+        query_list.append(PlanNode(query, variable_queries))
+    return query_list
+
+
+def _retrieve_alias(query: Expression) -> tuple[dict, dict]:
+    """
+    Parse the SQL Query and retrieve the relevant column alias with the attribute
 
-            LIMIT
-            ├── AGGREGATE
-            ├── SELECT <-- Inserted
-            │   ├── SORT
-            │   │   ├── JOIN
-            │   │   │   ├── FROM
-            │   │   │   └── FROM
-        """
+    :param query: SQL query
+    :return: A tuple of the dictionary which maps the attribute to its alias
+             and the subquery aliases it includes, see _retrieve_subquery_alias
 
-        query_plan = query_plan["Plan"]
-        query_list = []
-        plan_queue = queue.Queue()
-        plan_queue.put(query_plan)
-        while not plan_queue.empty():
-            plans = plan_queue.get()
-            try:
-                query = QueryType(plans["Node Type"])
-            except ValueError:
-                # Skip non-related Queries
-                query = None
-            variable_queries = dict()
-            for query_key in filter(lambda key: "Key" in key, plans):
-                variable_queries.update({query_key: plans.get(query_key)})
-            if "Plans" in plans:
-                for plan in plans["Plans"]:
-                    plan_queue.put(plan)
-            for query_key in filter(lambda key: key in cls._conditions, plans):
-                variable_queries.update({query_key: plans.get(query_key)})
-            # Only specific for limit to retrieve the condition (Plan rows)
-            # Retrieve Limit Rows
-            if query is not None and query is QueryType.LIMIT:
-                variable_queries.update({"Plan Rows": plans.get("Plan Rows", None)})
-            if query is not None and query is QueryType.AGGREGATE:
-                # Skips Partial Aggregation
-                if plans.get("Partial Mode") == "Partial":
-                    continue
-            if query is not None:
-                query_list.append({query: variable_queries})
-        return query_list
+    Example
+        >>> retrieve = _retrieve_alias(query="SELECT c_count, count(*) AS custdist FROM"
+        >>>                                      "(SELECT c_custkey, count(o_orderkey) FROM customer"
+        >>>                                      "LEFT OUTER JOIN orders ON c_custkey = o_custkey"
+        >>>                                      "AND o_comment not like '%unusual%packages%' "
+        >>>                                      "GROUP BY c_custkey ) as c_orders (c_custkey, c_count) "
+        >>>                                      "GROUP BY c_count "
+        >>>                                      "ORDER BY custdist DESC, c_count DESC;")
+        >>> print(retrieve[0])
+        {"c_count": "count(o_orderkey)", "custdist": "count(*)", "c_custkey": "c_custkey" }
 
-    @classmethod
-    def __retrieve_alias(cls, query: Expression) -> dict:
-        """
-        Parse the SQL Query and retrieve the relevant column alias with the attribute
+    """
 
-        :param query: SQL query
-        :return: A dictionary which maps the attribute to its alias
+    # Sanitize the attribute and the alias
+    # will keep the column name if alias is empty
+    aliases = dict()
+    for i in query.expressions:
+        # Each expression is only rendered and lowercased once
+        expression = str(i).lower()
+        column = expression.split()[0]
+        aliases[i.alias.lower() if i.alias != "" else column] = expression if _OVER_RE.search(expression) else column
 
-        Example
-            >>> retrieve = cls.__retrieve_alias(query="SELECT c_count, count(*) AS custdist FROM"
-            >>>                                      "(SELECT c_custkey, count(o_orderkey) FROM customer"
-            >>>                                      "LEFT OUTER JOIN orders ON c_custkey = o_custkey"
-            >>>                                      "AND o_comment not like '%unusual%packages%' "
-            >>>                                      "GROUP BY c_custkey ) as c_orders (c_custkey, c_count) "
-            >>>                                      "GROUP BY c_count "
-            >>>                                      "ORDER BY custdist DESC, c_count DESC;")
-            >>> print(retrieve)
-            {"c_count": "count(o_orderkey)", "custdist": "count(*)", "c_custkey": "c_custkey" }
+    subquery_alias = _retrieve_subquery_alias(query)
+    aliases.update(subquery_alias)
+    return aliases, subquery_alias
 
-        """
 
-        # Sanitize the attribute and the alias
-        # will keep the column name if alias is empty
-        aliases = {str(i.alias).lower() if i.alias != "" else str(i).split()[0].lower(): str(i).lower() if re.search(r'over\s*\(', str(i).lower()) else str(i).split()[0].lower()
-                for i in query.expressions}
-        
-        subquery_alias = cls.__retrieve_subquery_alias(query)
-        aliases.update(subquery_alias)
-        return aliases
+def _clean_and_replace_variables(query_list: list[PlanNode], aliases: dict) -> None:
+    """
+    .. ref::clean_label:
 
-    @classmethod
-    def __clean_and_replace_variables(cls, query_list: list[dict], aliases: dict) -> None:
-        """
-        .. ref::clean_label:
+    Combination of removing tables from columns and adding column alias into the variable
 
-        Combination of removing tables from columns and adding column alias into the variable
+    Notes:
 
-        Notes:
+    This method updates the object in the parameters (Not a good practice)
 
-        This method updates the object in the parameters (Not a good practice)
+    :param query_list: List of query which simulates a JSON list
+    :param aliases: A dictionary of items which contains the alias (key) and the column name (value)
 
-        :param query_list: List of query which simulates a JSON list
-        :param aliases: A dictionary of items which contains the alias (key) and the column name (value)
+    Example
+    >>> _clean_and_replace_variables(query_list=[(JOIN, {...}), (FROM, {...}), (FROM, {...})],
+    >>>                                 aliases={"c_count": "count(o_orderkey)", "custdist": "count(*)", "c_custkey": "c_custkey" })
 
-        Example
-        >>> cls.__clean_and_replace_variables(query_list=[{"JOIN":{...}}, {"FROM": {...}}, {"FROM": {...}}],
-        >>>                                 aliases={"c_count": "count(o_orderkey)", "custdist": "count(*)", "c_custkey": "c_custkey" })
+    """
 
-        """
+    alias_pattern, value_to_alias = _compile_aliases(aliases)
+    for _, query_variables in query_list:
+        # The keys are collected first since their values are replaced below
+        for variable in [key for key in query_variables if "Key" in key]:
+            variable_value = query_variables[variable]
+            # Most keys are lists of columns, but some such as the Cache Key of a Memoize node are a single string
+            if isinstance(variable_value, str):
+                query_variables[variable] = _clean_variable(alias_pattern, value_to_alias, variable_value)
+            else:
+                query_variables[variable] = ",".join([_clean_variable(alias_pattern, value_to_alias, variable_string)
+                                                      for variable_string in variable_value])
+        filter_string = query_variables.get("Filter", None)
+        if filter_string is not None:
+            query_variables["Filter"] = _convert_operation_and_clean_variables(filter_string)
+
+
+def _clean_variable(alias_pattern: re.Pattern, value_to_alias: dict, variable_string: str) -> str:
+    """
+    Remove the tables from a single variable and replace its columns by their alias
 
-        for query in query_list:
-            # Deconstructing the nested dictionary
-            query_variables = next(iter(query.values()))
-            for variable in list(filter(lambda items: "Key" in items, query_variables.keys())):
-                variable_list = []
-                for variable_string in query_variables.get(variable):
-                    temp_values = cls.__remove_tables_from_variables(variable_string)
-                    temp_values = cls.__add_table_alias(aliases, temp_values)
-                    variable_list.append(temp_values)
-
-                temp_string = ",".join(variable_list)
-                query_variables.update({variable: temp_string})
-            if query_variables.get("Filter", None) is not None:
-                temp_values = cls.__convert_operation_and_clean_variables(query_variables.get("Filter"))
-                query_variables.update({"Filter": temp_values})
+    Notes:
+    The tables are removed before the aliases are looked up, since the column names in the aliases
+    do not carry a table (e.g. count(c_acct_bal) for count(customer.c_acct_bal))
 
-    @classmethod
-    def __add_table_alias(cls, aliases: dict, variable_string: str) -> str:
-        """
-        .. ref::_add_table_label:
+    :param alias_pattern: The compiled pattern matching any column name with an alias (None if there is none)
+    :param value_to_alias: A dictionary which maps the column name to its alias
+    :param variable_string: The variable name that is obtained from QEP
+    :return: The cleaned variable
+    """
+    variable_string = _remove_tables_from_variables(variable_string)
+    # Without any alias there is nothing to replace
+    if alias_pattern is None:
+        return variable_string
+    return _add_table_alias(alias_pattern, value_to_alias, variable_string)
 
-        Add Alias into the respective column name based on the aliases
 
-        :param aliases: A dictionary of items which contains the alias (key) and the column name (value)
-        :param variable_string: The variable name that is obtained from QEP
-        :return: The string which is replaced by the alias or the original value
+def _compile_aliases(aliases: dict) -> tuple:
+    """
+    Build the lookup used by _add_table_alias once for all the variables of the query list
 
-        Example:
-        >>> print(cls.__add_table_alias(aliases={"custdist": "count(*)"}, variable_string="count(*)"))
-        custdist
-        """
-        temp_var = next((items for items in aliases.items() if items[1] in variable_string), None)
-        return variable_string.replace(temp_var[1], temp_var[0]) if temp_var is not None else variable_string
+    :param aliases: A dictionary of items which contains the alias (key) and the column name (value)
+    :return: A tuple of the compiled pattern matching any column name (None if there is nothing to replace)
+             and the dictionary which maps the column name back to its alias
+    """
+    value_to_alias = dict()
+    for key, value in aliases.items():
+        # Columns which alias to themselves do not need to be replaced
+        if key != value:
+            value_to_alias.setdefault(value, key)
+    if not value_to_alias:
+        return None, value_to_alias
+    # Longer column names are tried first so that e.g. count(o_orderkey) wins over o_orderkey.
+    # The lookarounds keep a column from matching inside a longer identifier, and unlike \b they
+    # also hold for column names that start or end with a bracket such as count(*)
+    alias_pattern = re.compile(r"(?<!\w)(?:"
+                               + "|".join(re.escape(value) for value in sorted(value_to_alias, key=len, reverse=True))
+                               + r")(?!\w)")
+    return alias_pattern, value_to_alias
+
+
+def _add_table_alias(alias_pattern: re.Pattern, value_to_alias: dict, variable_string: str) -> str:
+    """
+    .. ref::_add_table_label:
 
-    @classmethod
-    def __remove_tables_from_variables(cls, variable_string: str) -> str:
-        """
-        .. ref:_remove_table_label:
+    Add Alias into the respective column name based on the aliases
 
-        Removes the additional tables from the column names
+    :param alias_pattern: The compiled pattern matching any column name with an alias, see _compile_aliases
+    :param value_to_alias: A dictionary which maps the column name to its alias
+    :param variable_string: The variable name that is obtained from QEP
+    :return: The string which is replaced by the alias or the original value
 
-        Notes:
-        This function is simplistic in its implementation.
-        It does not check whether it is necessary to remove the table
-        It checks for 2 conditions:
-         - Whether a full stop is found
-         - Whether a bracket is found before the full stop
-        If it satisfies the two conditions:
-            - Remove any substring from ( and .
-        else If it satisfies the . condition
-            - Remove any substring before .
-        else
-            - Retains the original value
-
-        :param variable_string: Value which is used to check whether the value contains any of the above condition
-        :return: A string value
+    Example:
+    >>> print(_add_table_alias(*_compile_aliases({"custdist": "count(*)"}), variable_string="count(*)"))
+    custdist
+    """
+    # A bare column is usually the whole variable, which is a single dict lookup
+    alias = value_to_alias.get(variable_string)
+    if alias is not None:
+        return alias
+    return alias_pattern.sub(lambda match: value_to_alias[match.group(0)], variable_string)
 
-        Example
-        >>> print(cls.__remove_tables_from_variables("customer.c_custkey"))
-        c_custkey
-        >>> print(cls.__remove_tables_from_variables("count(customer.c_acct_bal)"))
-        count(c_acct_bal)
 
-        """
-        full_stop_index = variable_string.find(".")
-        bracket_index = variable_string.rfind("(", 0, full_stop_index)
-        # TODO
-        # Janky solution to finding and removing table from columns
-        # Assumed that full stop (.) is the main separator
-        if bracket_index < full_stop_index and bracket_index != -1:
-            temp_values = variable_string[:bracket_index] + "(" + variable_string[full_stop_index + 1:]
-        elif bracket_index == -1:
-            temp_values = variable_string[full_stop_index + 1:]
-        else:
-            temp_values = variable_string
-        return temp_values
+def _remove_tables_from_variables(variable_string: str) -> str:
+    """
+    .. ref:_remove_table_label:
 
-    @classmethod
-    def __convert_operation_and_clean_variables(cls, variable_string: str) -> str:
-        """
+    Removes the additional tables from the column names
 
-        Converts the operation into the Enumeration and remove any type fo variable
+    Notes:
+    This function is simplistic in its implementation.
+    It does not check whether it is necessary to remove the table
+    Every identifier, quoted or not, directly followed by a full stop and a column is treated as a table and removed,
+    except inside string literals. Values without a full stop are returned as they are
 
-        :param variable_string: The string type of the variable which needs to be converted
-        :return: A string output of the sanitized query
-        """
-        result_string = re.sub(r'::[^) ]*', ')', variable_string)
-        return result_string
+    :param variable_string: Value which is used to check whether the value contains any of the above condition
+    :return: A string value
 
-    @classmethod
-    def __inject_queries(cls, query: str, query_list: list, alias: dict):
-        """
-        Inject AS into AGGREGATE function and INJECT SELECT statement
+    Example
+    >>> print(_remove_tables_from_variables("customer.c_custkey"))
+    c_custkey
+    >>> print(_remove_tables_from_variables("count(customer.c_acct_bal)"))
+    count(c_acct_bal)
 
-        Notes:
-        This injection is sensitive to the query and will place
+    """
+    # Most variables have no table, so there is nothing left to scan for
+    if "." not in variable_string:
+        return variable_string
+    return _TABLE_RE.sub(_keep_literal, variable_string)
 
-        :param query: The SQL query that is executed
-        :param query_list: An arraylist of Query Execution Plan
-        :param alias: A dictionary of that contains column name alias and column names
 
-        """
-        parsed = sqlglot.parse_one(query)
-        temp_alias = copy.deepcopy(alias)
-        subquery_alias = cls.__retrieve_subquery_alias(parsed)
-        filtered_subquery = {k: v for k, v in subquery_alias.items() if k == v}
-        remove_key_list = alias.keys() & filtered_subquery.keys()
-        for remove_key in remove_key_list:
-            temp_alias.pop(remove_key, None)
-        alias_list = list((k, v) for k, v in temp_alias.items() if v in Aggregate)
-        alias_list.reverse()
-        aggregate_list = list(filter(lambda item: QueryType.AGGREGATE in item, query_list))
-        select_list = [v for k, v in temp_alias.items() if v not in Aggregate]
-        if aggregate_list:
-            for i in range(len(aggregate_list)):
-                if i < len(alias_list):
-                    if alias_list[i][0] != alias_list[i][1]:
-                        aggregate_list[i][QueryType.AGGREGATE].update(
-                            {"Index Name": f"{alias_list[i][1]} AS {alias_list[i][0]}"})
-                    else:
-                        aggregate_list[i][QueryType.AGGREGATE].update({"Index Name": f"{alias_list[i][1]}"})
-        # TODO
-        # ===============================================
-        # This solution might not be optimal as it will always insert the select statement next to the FROM/JOIN statement
-        # This might not be true if extend if inserted
-        if select_list:
-            query_list.insert(0, {QueryType.SELECT: {"Index Name": f"{','.join(select_list)}"}})
+def _keep_literal(match: re.Match) -> str:
+    # String literals are kept as-is, table qualifiers are dropped
+    return match.group(1) or ""
 
-    @classmethod
-    def __retrieve_subquery_alias(cls, parsed: Expression) -> dict:
-        """
 
-        Retrieve all subqueries from the query
+def _convert_operation_and_clean_variables(variable_string: str) -> str:
+    """
 
-        Note:
-        Have not tested out with a nested subquery
+    Converts the operation into the Enumeration and remove any type fo variable
 
-        :param parsed: An SQL Query which is parsed into sqlglot library and transformed into Expression object
-        :return: A dictionary which contains all the subqueries
-        """
-        # Retrieve all alias from the subquery
-        # TODO
-        # Will have to check whether alias is declared outside of subquery or within subquery
-        # Probably can ignore internal usage of column alias (Assumption)
-        sub_query_alias = dict()
-        for subquery in parsed.find_all(sqlglot.exp.Subquery):
-            # Alias declared externally
-            alias_column_names = tuple(subquery.alias_column_names)
-            # Get all the columns from the select
-            key_column_names = tuple(str(s).lower() for s in subquery.selects)
-            # Will ignore all keys that does not have an alias
-            sub_query_alias.update(dict(zip(alias_column_names, key_column_names)))
-        return sub_query_alias
+    :param variable_string: The string type of the variable which needs to be converted
+    :return: A string output of the sanitized query
+    """
+    # Most filters have no type cast, which skips the regex entirely
+    if "::" not in variable_string:
+        return variable_string
+    result_string = _CAST_RE.sub(')', variable_string)
+    return result_string
 
-    @classmethod
-    def __inject_where_condition(cls, query_list: list):
-        """
-        Injects Where condition into the query list.
 
-        Notes:
-        This func should always be inserted into the query list after the insertion of SELECT statement.
-        This statment will always be at the second position
-        It will ensure that the order of pipe syntax remains the same
-        where the row will be filtered before retrieving from the columns
-        :param query_list: List of query
-        """
-        from_range_filter = list(i for i, item in enumerate(query_list) if item.get(QueryType.FROM, None) is not None and item.get(QueryType.FROM).get("Filter", None) is not None)
-        for index in reversed(from_range_filter):
-            where_condition = query_list[index][QueryType.FROM].get("Filter", None)
-            if where_condition is not None:
-                query_list.insert(index, {QueryType.WHERE: {"Index Name": where_condition}})
-        
-        from_range_index = list(i for i, item in enumerate(query_list) if item.get(QueryType.FROM, None) is not None and item.get(QueryType.FROM).get("Index Cond", None) is not None)
-        for index in reversed(from_range_index):
-            where_condition = query_list[index][QueryType.FROM].get("Index Cond", None)
-            if where_condition is not None:
-                query_list.insert(index, {QueryType.WHERE: {"Index Name": where_condition}})
-            
-    @classmethod   
-    def __inject_set_statement(cls, query: str, query_list: list, alias: dict):
-        """
-        Injects SET statememt where UPDATE exists
-        """
-        update_index = next((i for i, query in enumerate(query_list) if QueryType.UPDATE in query), -1)
-        
-        if update_index != -1:
-            
-            match = re.search(r'\bSET\b\s+(.*?)(?=\bFROM\b|\bWHERE\b|;|$)', query, re.IGNORECASE | re.DOTALL)
-            set_statement = match.group(1).strip()
-            
-            if set_statement is not None:
-                for a in alias:
-                    set_statement = re.sub(rf'\b{re.escape(a)}\b', a.lower(), set_statement, flags=re.IGNORECASE)
-                query_list.insert(update_index, {QueryType.SET: {"Set Statement": set_statement}})
-
-                if update_index - 1 >= 0:
-                    if QueryType.SELECT in query_list[update_index - 1]:
-                        query_list.pop(update_index - 1)
-                        
+def _inject_queries(query_list: list, alias: dict, subquery_alias: dict):
+    """
+    Inject AS into AGGREGATE function and INJECT SELECT statement
+
+    Notes:
+    This injection is sensitive to the query and will place
+
+    :param query_list: An arraylist of Query Execution Plan
+    :param alias: A dictionary of that contains column name alias and column names
+    :param subquery_alias: The aliases declared by the subqueries, retrieved together with alias
+
+    """
+    # Nothing is injected without any column
+    if not alias:
+        return
+    temp_alias = alias.copy()
+    filtered_subquery = {k: v for k, v in subquery_alias.items() if k == v}
+    remove_key_list = alias.keys() & filtered_subquery.keys()
+    for remove_key in remove_key_list:
+        temp_alias.pop(remove_key, None)
+    # Split the columns into aggregates and plain selects in a single pass
+    alias_list = []
+    select_list = []
+    for k, v in temp_alias.items():
+        if v in Aggregate:
+            alias_list.append((k, v))
+        else:
+            select_list.append(v)
+    alias_list.reverse()
+    aggregate_list = [query_variables for query, query_variables in query_list if query is QueryType.AGGREGATE]
+    if aggregate_list:
+        for i in range(len(aggregate_list)):
+            if i < len(alias_list):
+                if alias_list[i][0] != alias_list[i][1]:
+                    aggregate_list[i]["Index Name"] = f"{alias_list[i][1]} AS {alias_list[i][0]}"
+                else:
+                    aggregate_list[i]["Index Name"] = f"{alias_list[i][1]}"
+    # TODO
+    # ===============================================
+    # This solution might not be optimal as it will always insert the select statement next to the FROM/JOIN statement
+    # This might not be true if extend if inserted
+    if select_list:
+        query_list.insert(0, PlanNode(QueryType.SELECT, {"Index Name": f"{','.join(select_list)}"}))
+
+
+def _retrieve_subquery_alias(parsed: Expression) -> dict:
+    """
+
+    Retrieve all subqueries from the query
+
+    Note:
+    Have not tested out with a nested subquery
+
+    :param parsed: An SQL Query which is parsed into sqlglot library and transformed into Expression object
+    :return: A dictionary which contains all the subqueries
+    """
+    # Retrieve all alias from the subquery
+    # TODO
+    # Will have to check whether alias is declared outside of subquery or within subquery
+    # Probably can ignore internal usage of column alias (Assumption)
+    sub_query_alias = dict()
+    for subquery in parsed.find_all(sqlglot.exp.Subquery):
+        # Alias declared externally
+        alias_column_names = tuple(subquery.alias_column_names)
+        # Get all the columns from the select
+        key_column_names = tuple(str(s).lower() for s in subquery.selects)
+        # Will ignore all keys that does not have an alias
+        sub_query_alias.update(dict(zip(alias_column_names, key_column_names)))
+    return sub_query_alias
+
+
+def _inject_where_condition(query_list: list):
+    """
+    Injects Where condition into the query list.
+
+    Notes:
+    This func should always be inserted into the query list after the insertion of SELECT statement.
+    This statment will always be at the second position
+    It will ensure that the order of pipe syntax remains the same
+    where the row will be filtered before retrieving from the columns
+    :param query_list: List of query
+    """
+    # Rebuild the list in one pass: the Filter and then the Index Cond are placed before their FROM
+    injected_list = []
+    for item in query_list:
+        query, query_variables = item
+        if query is QueryType.FROM:
+            for condition in ("Filter", "Index Cond"):
+                where_condition = query_variables.get(condition, None)
+                if where_condition is not None:
+                    injected_list.append(PlanNode(QueryType.WHERE, {"Index Name": where_condition}))
+        injected_list.append(item)
+    query_list[:] = injected_list
+
+
+def _inject_set_statement(query: str, query_list: list, alias: dict):
+    """
+    Injects SET statememt where UPDATE exists
+    """
+    update_index = next((i for i, (query_type, _) in enumerate(query_list) if query_type is QueryType.UPDATE), -1)
+
+    if update_index != -1:
+
+        match = _SET_RE.search(query)
+        set_statement = match.group(1).strip()
+
+        if set_statement is not None:
+            if alias:
+                # Lowercase every alias in one pass, trying the longer aliases first
+                alias_pattern = re.compile(r'\b(?:' + '|'.join(re.escape(a) for a in sorted(alias, key=len, reverse=True))
+                                           + r')\b', re.IGNORECASE)
+                set_statement = alias_pattern.sub(lambda m: m.group(0).lower(), set_statement)
+            # Rebuild the list once: SET goes before UPDATE and replaces the SELECT right before it
+            preceding_list = query_list[:update_index]
+            if preceding_list and preceding_list[-1].query_type is QueryType.SELECT:
+                preceding_list.pop()
+            query_list[:] = preceding_list + [PlanNode(QueryType.SET, {"Set Statement": set_statement})] + query_list[update_index:]
+
 
 def flatten(nested_list: list) -> list:
-    return [item for sublist in nested_list for item in sublist[0]]
+    return list(chain.from_iterable(sublist[0] for sublist in nested_list))
 
 
-def get_qep(query: str, db: DBConnection):
-    qep_query = "EXPLAIN (ANALYZE, FORMAT JSON)" + query
-    return db.execute(qep_query)
+def get_qep(query: str, db: DBConnection) -> dict:
+    qep_query = _EXPLAIN + query
+    # EXPLAIN returns a single row whose only column is the JSON list holding the plan
+    return db.execute_one(qep_query)[0][0]
 
 
+# The parsed expression is shared between callers, so it must only be read and never modified
+@functools.lru_cache(maxsize=256)
 def validate_query(query: str):
     try:
-        transpiled = \
-        sqlglot.transpile(query, write="postgres", read="postgres", pretty=True, error_level=sqlglot.ErrorLevel.RAISE)[
-            0]
-        parsed = sqlglot.parse_one(transpiled)
-
-        #check that query is DML
-        if parsed is not None:
-            if parsed.key.upper() in {"SELECT", "INSERT", "UPDATE", "DELETE"}:
-                return parsed
-            raise ValueError("Only Data Manipulation Language (DML) queries (SELECT, INSERT, UPDATE, DELETE) are allowed.")
+        expression = _POSTGRES.parse(query, error_level=sqlglot.ErrorLevel.RAISE)[0]
+
+        #check that query is DML, before paying for the round trip below
+        if expression is not None:
+            if expression.key.upper() not in {"SELECT", "INSERT", "UPDATE", "DELETE"}:
+                raise ValueError("Only Data Manipulation Language (DML) queries (SELECT, INSERT, UPDATE, DELETE) are allowed.")
+            # The generic re-parse is kept on purpose: the aliases are rendered from this tree and have to
+            # match the text of the plan (e.g. date_trunc instead of the Postgres-only TIMESTAMP_TRUNC node).
+            # The tree is only generated once, so the generator does not need to copy it
+            transpiled = _POSTGRES.generate(expression, copy=False, pretty=True)
+            return sqlglot.parse_one(transpiled)
+        # An empty, semicolon-only or comment-only query has no statement to explain
+        raise sqlglot.ParseError("Error in parsing SQL. Please ensure that the query is valid!")
 
     except sqlglot.ParseError:
         error_output = "Error in parsing SQL. Please ensure that the query is valid!"
@@ -591,5 +784,6 @@ def example():
     print(Parser.parse_query(qep_list))
 
 
-# Remove the comment below the run the code
-example()
+# Only run the example when the module is executed directly, importing it must not query the database
+if __name__ == "__main__":
+    example()